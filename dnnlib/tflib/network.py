@@ -530,11 +530,14 @@ class Network:
         to be slightly closer to those of the given network."""
         with tfutil.absolute_name_scope(self.scope + "/_MovingAvg"):
             ops = []
+            src_vars = src_net._get_vars()
             for name, var in self._get_vars().items():
-                if name in src_net._get_vars():
+                if name in src_vars:
                     cur_beta = beta if var.trainable else beta_nontrainable
-                    new_value = tfutil.lerp(src_net._get_vars()[name], var, cur_beta)
-                    ops.append(var.assign(new_value))
+                    if isinstance(cur_beta, (int, float)) and cur_beta == 0:
+                        ops.append(var.assign(src_vars[name])) # plain copy, nothing to blend
+                    else:
+                        ops.append(var.assign_sub((var - src_vars[name]) * (1 - cur_beta))) # in-place lerp(src, var, beta)
             return tf.group(*ops)
 
     def run(self,
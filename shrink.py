@@ -1,16 +1,30 @@
 from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
 
-print("shrinking images in folder")
 
-folder = input("folder path: ")
-w = int(input("width: "))
-h = int(input("height: "))
+def _shrink(path, w, h):
+    im = Image.open(path)
+    im = im.resize((w, h), Image.LANCZOS)
+    im.save(path)
 
-for file in os.listdir(folder):
-    new_file = f"{folder}\\{file}"
-    im = Image.open(new_file)
-    im = im.resize((w, h), Image.ANTIALIAS)
-    im.save(new_file)
 
-print("Done")
+def main():
+    print("shrinking images in folder")
+
+    folder = input("folder path: ")
+    w = int(input("width: "))
+    h = int(input("height: "))
+
+    # Every file is independent, so fan them out over all cores.
+    with os.scandir(folder) as it:
+        paths = [entry.path for entry in it if entry.is_file()]
+    with ProcessPoolExecutor() as ex:
+        list(ex.map(partial(_shrink, w=w, h=h), paths, chunksize=16))
+
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
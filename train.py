@@ -422,9 +422,19 @@ def setup_training_options(
 
 #----------------------------------------------------------------------------
 
-def run_training(outdir, seed, dry_run, **hyperparam_options):
+def run_training(outdir, seed, dry_run, xla, intra_threads, inter_threads, **hyperparam_options):
+    # Setup session options. Thread counts of 0 keep TensorFlow's defaults.
+    session_options = dnnlib.EasyDict(xla=xla, intra_threads=intra_threads, inter_threads=inter_threads)
+    tf_config = {
+        'rnd.np_random_seed': seed,
+        'intra_op_parallelism_threads': intra_threads, # Threads used within a single op, shared by all GPU towers.
+        'inter_op_parallelism_threads': inter_threads, # Threads for the executor and tf.data, shared by all GPU towers.
+    }
+    if xla:
+        tf_config['graph_options.optimizer_options.global_jit_level'] = tf.OptimizerOptions.ON_1 # Auto-cluster XLA-compatible ops.
+    tflib.init_tf(tf_config)
+
     # Setup training options.
-    tflib.init_tf({'rnd.np_random_seed': seed})
     run_desc, training_options = setup_training_options(**hyperparam_options)
 
     # Pick output directory.
@@ -447,6 +457,7 @@ def run_training(outdir, seed, dry_run, **hyperparam_options):
     print(f'Training length:   {training_options.total_kimg} kimg')
     print(f'Resolution:        {training_options.train_dataset_args.resolution}')
     print(f'Number of GPUs:    {training_options.num_gpus}')
+    print(f'Session options:   {json.dumps(session_options)}')
     print()
 
     # Dry run?
@@ -458,7 +469,7 @@ def run_training(outdir, seed, dry_run, **hyperparam_options):
     print('Creating output directory...')
     os.makedirs(training_options.run_dir)
     with open(os.path.join(training_options.run_dir, 'training_options.json'), 'wt') as f:
-        json.dump(training_options, f, indent=2)
+        json.dump(dict(training_options, session_options=session_options), f, indent=2)
     with dnnlib.util.Logger(os.path.join(training_options.run_dir, 'log.txt')):
         training_loop.training_loop(**training_options)   # PASSING CONTROL TO TRAINING_LOOP.PY
 
@@ -532,6 +543,9 @@ def main():
     group.add_argument('--snap', help='Snapshot interval (default: 50 ticks)', type=int, metavar='INT')
     group.add_argument('--seed', help='Random seed (default: %(default)s)', type=int, default=1000, metavar='INT')
     group.add_argument('-n', '--dry-run', help='Print training options and exit', action='store_true', default=False)
+    group.add_argument('--xla', help='Compile fusable ops with XLA (default: false)', type=_str_to_bool, default=False, metavar='BOOL')
+    group.add_argument('--intra-threads', help='TensorFlow intra-op thread pool size, 0 = TensorFlow default (default: %(default)s)', type=int, default=0, metavar='INT')
+    group.add_argument('--inter-threads', help='TensorFlow inter-op thread pool size, 0 = TensorFlow default (default: %(default)s)', type=int, default=0, metavar='INT')
 
     group = parser.add_argument_group('training dataset')
     group.add_argument('--data',   help='Training dataset path (required)', metavar='PATH', required=True)
@@ -11,6 +11,7 @@
 import os
 import pickle
 import time
+import concurrent.futures
 import PIL.Image
 import numpy as np
 import tensorflow as tf
@@ -22,12 +23,16 @@ from collections import OrderedDict
 
 from training import dataset
 
+try:
+    import cv2 # optional, faster PNG encoder for the snapshot grids
+except ImportError:
+    cv2 = None
+
 
 # ----------------------------------------------------------------------------
 # Select size and contents of the image snapshot grids that are exported
 # periodically during training.
 
-# no change
 def setup_snapshot_image_grid(training_set):
     gw = np.clip(7680 // training_set.shape[2], 7, 32)
     gh = np.clip(4320 // training_set.shape[1], 4, 32)
@@ -37,50 +42,63 @@ def setup_snapshot_image_grid(training_set):
         reals, labels = training_set.get_minibatch_np(gw * gh)
         return (gw, gh), reals, labels
 
-    # Row per class.
-    cw, ch = (gw, 1)
-    nw = (gw - 1) // cw + 1
-    nh = (gh - 1) // ch + 1
-
-    # Collect images.
-    blocks = [[] for _i in range(nw * nh)]
-    for _iter in range(1000000):
-        real, label = training_set.get_minibatch_np(1)
-        idx = np.argmax(label[0])
-        while idx < len(blocks) and len(blocks[idx]) >= cw * ch:
-            idx += training_set.label_size
-        if idx < len(blocks):
-            blocks[idx].append((real, label))
-            if all(len(block) >= cw * ch for block in blocks):
-                break
-
-    # Layout grid.
+    # Row per class. Row y holds class y % label_size, so classes wrap around when there are more rows than classes.
+    label_size = training_set.label_size
+    need = np.bincount(np.arange(gh) % label_size, minlength=label_size) * gw
+    have = np.zeros_like(need)
     reals = np.zeros([gw * gh] + training_set.shape, dtype=training_set.dtype)
-    labels = np.zeros([gw * gh, training_set.label_size], dtype=training_set.label_dtype)
-    for i, block in enumerate(blocks):
-        for j, (real, label) in enumerate(block):
-            x = (i % nw) * cw + j % cw
-            y = (i // nw) * ch + j // cw
-            if x < gw and y < gh:
-                reals[x + y * gw] = real[0]
-                labels[x + y * gw] = label[0]
+    labels = np.zeros([gw * gh, label_size], dtype=training_set.label_dtype)
+
+    # Collect images, bucketing each batch by class and scattering the samples straight into their grid cells.
+    batch_size = gw * gh * 4
+    for _iter in range(1000000 // batch_size + 1):
+        real, label = training_set.get_minibatch_np(batch_size)
+        cls = np.argmax(label, axis=1)
+        order = np.argsort(cls, kind='stable')
+        starts = np.searchsorted(cls[order], np.arange(label_size))
+        counts = np.bincount(cls, minlength=label_size)
+        for c in np.flatnonzero(have < need):
+            num = min(counts[c], need[c] - have[c])
+            take = order[starts[c] : starts[c] + num]
+            rank = np.arange(have[c], have[c] + num)
+            cell = (c + rank // gw * label_size) * gw + rank % gw
+            reals[cell] = real[take]
+            labels[cell] = label[take]
+            have[c] += num
+        if np.all(have >= need):
+            break
+
     return (gw, gh), reals, labels
 
 
 # ----------------------------------------------------------------------------
 
-# no change
-def save_image_grid(images, filename, drange, grid_size):
+def save_image_grid(images, filename, drange, grid_size, compress_level=6):
     lo, hi = drange
     gw, gh = grid_size
-    images = np.asarray(images, dtype=np.float32)
-    images = (images - lo) * (255 / (hi - lo))
-    images = np.rint(images).clip(0, 255).astype(np.uint8)
+    images = np.subtract(images, lo, dtype=np.float32) # fresh float32 buffer, rescaled in place below
+    np.multiply(images, 255 / (hi - lo), out=images)
+    np.rint(images, out=images)
+    np.clip(images, 0, 255, out=images)
+    images = images.astype(np.uint8)
     _N, C, H, W = images.shape
-    images = images.reshape(gh, gw, C, H, W)
-    images = images.transpose(0, 3, 1, 4, 2)
-    images = images.reshape(gh * H, gw * W, C)
-    PIL.Image.fromarray(images, {3: 'RGB', 1: 'L'}[C]).save(filename)
+    step = -1 if cv2 is not None else 1 # OpenCV expects BGR channel order
+    grid = np.empty([gh * H, gw * W, C], dtype=np.uint8)
+    for iy in range(gh):
+        for ix in range(gw):
+            grid[iy * H : (iy + 1) * H, ix * W : (ix + 1) * W] = images[iy * gw + ix, ::step].transpose(1, 2, 0)
+    if cv2 is not None:
+        if cv2.imwrite(filename, grid, [cv2.IMWRITE_PNG_COMPRESSION, compress_level]):
+            return
+        grid = np.ascontiguousarray(grid[..., ::-1]) # OpenCV failed (e.g. non-ASCII path on Windows), retry with PIL in RGB order
+    PIL.Image.fromarray(grid, {3: 'RGB', 1: 'L'}[C]).save(filename, compress_level=compress_level)
+
+
+# ----------------------------------------------------------------------------
+
+def write_file(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(data)
 
 
 # ----------------------------------------------------------------------------
@@ -169,12 +187,14 @@ def training_loop(
     #print("Num GPUs:", len(physical_devices))
     print(tf.test.is_gpu_available())
     print('Exporting sample images...')
+    print('PNG encoder:', 'OpenCV' if cv2 is not None else 'PIL')
 
     grid_size, grid_reals, grid_labels = setup_snapshot_image_grid(training_set)
     save_image_grid(grid_reals, os.path.join(run_dir, 'reals.png'), drange=[0, 255], grid_size=grid_size)
     grid_latents = np.random.randn(np.prod(grid_size), *G.input_shape[1:])
     grid_fakes = Gs.run(grid_latents, grid_labels, is_validation=True, minibatch_size=minibatch_gpu)[0]
-    save_image_grid(grid_fakes, os.path.join(run_dir, 'fakes_init.png'), drange=[-1, 1], grid_size=grid_size)
+    save_image_grid(grid_fakes, os.path.join(run_dir, 'fakes_init.png'), drange=[-1, 1], grid_size=grid_size,
+                    compress_level=1)
 
 
 # Tabriz: no change
@@ -277,6 +297,8 @@ def training_loop(
 
             # assert terms.D_loss == tf.reduce_mean(terms.D_loss)
 
+            # Gradients are registered per tower; apply_updates() sums them across GPUs (NCCL all-reduce),
+            # scales by 1 / num_gpus and applies the same averaged update to every replica.
             G_E_opt.register_gradients(terms.G_E_loss, OrderedDict(chain(G_gpu.trainables.items(),
                                                                        E_gpu.trainables.items())))
             # Tabriz: Can be wrong
@@ -300,6 +322,17 @@ def training_loop(
     D_reg_op = D_reg_opt.apply_updates(allow_no_op=True)
     Gs_beta_in = tf.placeholder(tf.float32, name='Gs_beta_in', shape=[])
     Gs_update_op = Gs.setup_as_moving_average_of(G, beta=Gs_beta_in)
+
+    # Snapshot grid latents and labels are uploaded once and stay on the device. A single copy of the Gs graph
+    # evaluates one minibatch_gpu-sized chunk of them at a time, selected by offset.
+    with tf.name_scope('GridFakes'), tf.device('/gpu:0'):
+        grid_latents_var = tflib.create_var_with_large_initial_value(grid_latents.astype(np.float32), name='latents', trainable=False)
+        grid_labels_var = tflib.create_var_with_large_initial_value(grid_labels.astype(np.float32), name='labels', trainable=False)
+        grid_offset_in = tf.placeholder(tf.int32, name='offset_in', shape=[])
+        grid_fakes_chunk = Gs.get_output_for(
+            grid_latents_var[grid_offset_in : grid_offset_in + minibatch_gpu],
+            grid_labels_var[grid_offset_in : grid_offset_in + minibatch_gpu],
+            is_validation=True)[0]
     tflib.init_uninitialized_vars()
     with tf.device('/gpu:0'):
         peak_gpu_mem_op = tf.contrib.memory_stats.MaxBytesInUse()
@@ -323,106 +356,144 @@ def training_loop(
     tick_start_nimg = cur_nimg
     running_mb_counter = 0  # Tabriz: Mini batch counter
 
-    done = False
-    while not done:  # Tabriz: training starts here
-
-        # Compute EMA decay parameter.
-        Gs_nimg = G_smoothing_kimg * 1000.0
-        if G_smoothing_rampup is not None:
-            Gs_nimg = min(Gs_nimg, cur_nimg * G_smoothing_rampup)
-        Gs_beta = 0.5 ** (minibatch_size / max(Gs_nimg, 1e-8))
-
-        # Run training ops.
-        for _repeat_idx in range(minibatch_repeats):
-            rounds = range(0, minibatch_size, minibatch_gpu * num_gpus)
-            run_G_reg = (lazy_regularization and running_mb_counter % G_reg_interval == 0)
-            # Tabriz: For every g_reg interval it becomes True
-            run_D_reg = (lazy_regularization and running_mb_counter % D_reg_interval == 0)
-            cur_nimg += minibatch_size
-            running_mb_counter += 1
-
-            # Fast path without gradient accumulation.
-            if len(rounds) == 1:
-                # tflib.run([D_train_op, Gs_update_op], {Gs_beta_in: Gs_beta}) # need to delete it later
-                tflib.run([G_train_op, data_fetch_op]) # Tabriz: image shape was [32, 3, 3, 512, 512] some shit is going on, same with original no worries
-                if run_G_reg:
-                    tflib.run(G_reg_op)
-                tflib.run([D_train_op, Gs_update_op], {Gs_beta_in: Gs_beta})
-                if run_D_reg:
-                    tflib.run(D_reg_op)
-
-            # Slow path with gradient accumulation.
-            else:
-                for _round in rounds:
-                    tflib.run(G_train_op)
+    # Encode and write snapshots in the background so that training resumes immediately.
+    save_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    save_futures = []
+    pkl_future = None
+
+    # Loop invariants. The EMA feed dict is reused across steps and only updated while the EMA ramps up.
+    rounds = range(0, minibatch_size, minibatch_gpu * num_gpus)
+    fast_path = (len(rounds) == 1)
+    Gs_nimg = G_smoothing_kimg * 1000.0
+    Gs_beta_feed = {Gs_beta_in: 0.5 ** (minibatch_size / max(Gs_nimg, 1e-8))}
+    peak_gpu_mem = None # fetched alongside the EMA update on the last step before a tick, None = not fetched yet
+
+    try:
+        done = False
+        while not done:  # Tabriz: training starts here
+
+            # Compute EMA decay parameter.
+            if G_smoothing_rampup is not None:
+                Gs_beta_feed[Gs_beta_in] = 0.5 ** (minibatch_size / max(min(Gs_nimg, cur_nimg * G_smoothing_rampup), 1e-8))
+
+            # Run training ops.
+            for repeat_idx in range(minibatch_repeats):
+                run_G_reg = (lazy_regularization and running_mb_counter % G_reg_interval == 0)
+                # Tabriz: For every g_reg interval it becomes True
+                run_D_reg = (lazy_regularization and running_mb_counter % D_reg_interval == 0)
+                cur_nimg += minibatch_size
+                running_mb_counter += 1
+                tick_due = (repeat_idx == minibatch_repeats - 1) and (cur_tick < 0 or cur_nimg >= total_kimg * 1000 or
+                                                                      cur_nimg >= tick_start_nimg + kimg_per_tick * 1000)
+
+                # Fast path without gradient accumulation.
+                # G and D steps are kept in separate session runs on purpose: the D step reads G's weights and must
+                # see them after the G update, and tf.control_dependencies cannot be attached to the training ops once
+                # they have been built by apply_updates(). Fetching both in one run would race on the shared variables.
+                if fast_path:
+                    # tflib.run([D_train_op, Gs_update_op], {Gs_beta_in: Gs_beta}) # need to delete it later
+                    tflib.run([G_train_op, data_fetch_op]) # Tabriz: image shape was [32, 3, 3, 512, 512] some shit is going on, same with original no worries
                     if run_G_reg:
                         tflib.run(G_reg_op)
-                tflib.run(Gs_update_op, {Gs_beta_in: Gs_beta})
-                for _round in rounds:
-                    tflib.run(data_fetch_op)
-                    tflib.run(D_train_op)
+                    if tick_due:
+                        peak_gpu_mem = tflib.run([D_train_op, Gs_update_op, peak_gpu_mem_op], Gs_beta_feed)[-1]
+                    else:
+                        tflib.run([D_train_op, Gs_update_op], Gs_beta_feed)
                     if run_D_reg:
                         tflib.run(D_reg_op)
 
-            # Run validation.
+                # Slow path with gradient accumulation.
+                else:
+                    for _round in rounds:
+                        tflib.run(G_train_op)
+                        if run_G_reg:
+                            tflib.run(G_reg_op)
+                    if tick_due:
+                        peak_gpu_mem = tflib.run([Gs_update_op, peak_gpu_mem_op], Gs_beta_feed)[-1]
+                    else:
+                        tflib.run(Gs_update_op, Gs_beta_feed)
+                    for _round in rounds:
+                        tflib.run(data_fetch_op)
+                        tflib.run(D_train_op)
+                        if run_D_reg:
+                            tflib.run(D_reg_op)
+
+                # Run validation.
+                if aug is not None:
+                    aug.run_validation(minibatch_size=minibatch_size)
+
+            # Tune augmentation parameters.
             if aug is not None:
-                aug.run_validation(minibatch_size=minibatch_size)
-
-        # Tune augmentation parameters.
-        if aug is not None:
-            aug.tune(minibatch_size * minibatch_repeats)
-
-        # Perform maintenance tasks once per tick.
-        done = (cur_nimg >= total_kimg * 1000) or (abort_fn is not None and abort_fn())
-        if done or cur_tick < 0 or cur_nimg >= tick_start_nimg + kimg_per_tick * 1000:
-            cur_tick += 1
-            tick_kimg = (cur_nimg - tick_start_nimg) / 1000.0
-            tick_start_nimg = cur_nimg
-            tick_end_time = time.time()
-            total_time = tick_end_time - start_time
-            tick_time = tick_end_time - tick_start_time
-
-            # Report progress.
-            print(' '.join([
-                f"tick {autosummary('Progress/tick', cur_tick):<5d}",
-                f"kimg {autosummary('Progress/kimg', cur_nimg / 1000.0):<8.1f}",
-                f"time {dnnlib.util.format_time(autosummary('Timing/total_sec', total_time)):<12s}",
-                f"sec/tick {autosummary('Timing/sec_per_tick', tick_time):<7.1f}",
-                f"sec/kimg {autosummary('Timing/sec_per_kimg', tick_time / tick_kimg):<7.2f}",
-                f"maintenance {autosummary('Timing/maintenance_sec', maintenance_time):<6.1f}",
-                f"gpumem {autosummary('Resources/peak_gpu_mem_gb', peak_gpu_mem_op.eval() / 2 ** 30):<5.1f}",
-                f"augment {autosummary('Progress/augment', aug.strength if aug is not None else 0):.3f}",
-            ]))
-            autosummary('Timing/total_hours', total_time / (60.0 * 60.0))
-            autosummary('Timing/total_days', total_time / (24.0 * 60.0 * 60.0))
-            if progress_fn is not None:
-                progress_fn(cur_nimg // 1000, total_kimg)
-
-            # Save snapshots.
-            # Tabriz: Need to save also E, D_H, D_J
-            if image_snapshot_ticks is not None and (done or cur_tick % image_snapshot_ticks == 0):
-                grid_fakes = Gs.run(grid_latents, grid_labels, is_validation=True, minibatch_size=minibatch_gpu)[0]
-                save_image_grid(grid_fakes, os.path.join(run_dir, f'fakes{cur_nimg // 1000:06d}.png'), drange=[-1, 1],
-                                grid_size=grid_size)
-
-            if network_snapshot_ticks is not None and (done or cur_tick % network_snapshot_ticks == 0):
-                pkl = os.path.join(run_dir, f'network-snapshot-{cur_nimg // 1000:06d}.pkl')
-                with open(pkl, 'wb') as f:
-                    pickle.dump((G, D, Gs, E, D_H, D_J), f)
-                if len(metrics):
-                    print('Evaluating metrics...')
-                    for metric in metrics:
-                        metric.run(pkl, num_gpus=num_gpus)
-
-            # Update summaries.
-            for metric in metrics:
-                metric.update_autosummaries()
-            tflib.autosummary.save_summaries(summary_log, cur_nimg)
-            tick_start_time = time.time()
-            maintenance_time = tick_start_time - tick_end_time
+                aug.tune(minibatch_size * minibatch_repeats)
+
+            # Perform maintenance tasks once per tick.
+            done = (cur_nimg >= total_kimg * 1000) or (abort_fn is not None and abort_fn())
+            if done or cur_tick < 0 or cur_nimg >= tick_start_nimg + kimg_per_tick * 1000:
+                cur_tick += 1
+                tick_kimg = (cur_nimg - tick_start_nimg) / 1000.0
+                snapshot_kimg = cur_nimg // 1000 # shared by progress_fn and the snapshot file names
+                tick_start_nimg = cur_nimg
+                tick_end_time = time.time()
+                total_time = tick_end_time - start_time
+                tick_time = tick_end_time - tick_start_time
+                if peak_gpu_mem is None: # tick not predicted, e.g. ended early by abort_fn
+                    peak_gpu_mem = peak_gpu_mem_op.eval()
+
+                # Report progress.
+                print(' '.join([
+                    f"tick {autosummary('Progress/tick', cur_tick):<5d}",
+                    f"kimg {autosummary('Progress/kimg', cur_nimg / 1000.0):<8.1f}",
+                    f"time {dnnlib.util.format_time(autosummary('Timing/total_sec', total_time)):<12s}",
+                    f"sec/tick {autosummary('Timing/sec_per_tick', tick_time):<7.1f}",
+                    f"sec/kimg {autosummary('Timing/sec_per_kimg', tick_time / tick_kimg):<7.2f}",
+                    f"maintenance {autosummary('Timing/maintenance_sec', maintenance_time):<6.1f}",
+                    f"gpumem {autosummary('Resources/peak_gpu_mem_gb', peak_gpu_mem / 2 ** 30):<5.1f}",
+                    f"augment {autosummary('Progress/augment', aug.strength if aug is not None else 0):.3f}",
+                ]))
+                peak_gpu_mem = None
+                autosummary('Timing/total_hours', total_time / (60.0 * 60.0))
+                autosummary('Timing/total_days', total_time / (24.0 * 60.0 * 60.0))
+                if progress_fn is not None:
+                    progress_fn(snapshot_kimg, total_kimg)
+
+                # Save snapshots. Raise errors from earlier background saves now rather than at exit.
+                # Tabriz: Need to save also E, D_H, D_J
+                for future in [future for future in save_futures if future.done()]:
+                    save_futures.remove(future)
+                    future.result()
+                if image_snapshot_ticks is not None and (done or cur_tick % image_snapshot_ticks == 0):
+                    grid_fakes = np.concatenate([tflib.run(grid_fakes_chunk, {grid_offset_in: begin})
+                                                 for begin in range(0, len(grid_latents), minibatch_gpu)])
+                    save_futures.append(save_pool.submit(
+                        save_image_grid, grid_fakes, os.path.join(run_dir, f'fakes{snapshot_kimg:06d}.png'),
+                        drange=[-1, 1], grid_size=grid_size, compress_level=1))
+
+                if network_snapshot_ticks is not None and (done or cur_tick % network_snapshot_ticks == 0):
+                    pkl = os.path.join(run_dir, f'network-snapshot-{snapshot_kimg:06d}.pkl')
+                    if pkl_future is not None:
+                        pkl_future.result() # at most one pickle buffer queued, and write errors surface here
+                    pkl_data = pickle.dumps((G, D, Gs, E, D_H, D_J), protocol=pickle.HIGHEST_PROTOCOL) # fetch weights now, write later
+                    pkl_future = save_pool.submit(write_file, pkl, pkl_data)
+                    save_futures.append(pkl_future)
+                    if len(metrics):
+                        pkl_future.result() # metrics load the pickle back from disk
+                        print('Evaluating metrics...')
+                        for metric in metrics:
+                            metric.run(pkl, num_gpus=num_gpus)
+
+                # Update summaries.
+                for metric in metrics:
+                    metric.update_autosummaries()
+                tflib.autosummary.save_summaries(summary_log, cur_nimg)
+                tick_start_time = time.time()
+                maintenance_time = tick_start_time - tick_end_time
+    finally:
+        save_pool.shutdown() # drain pending snapshot writes, also when training fails
 
     print()
     print('Exiting...')
+    for future in save_futures:
+        future.result()
     summary_log.close()
     training_set.close()
 